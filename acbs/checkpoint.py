@@ -41,8 +41,7 @@ def checkpoint_text(packages: List[ACBSPackageInfo]) -> str:
 
 def checkpoint_to_group(packages: List[ACBSPackageInfo], path: str) -> str:
     groups = os.path.join(path, 'groups')
-    if not os.path.isdir(groups):
-        os.makedirs(groups)
+    os.makedirs(groups, exist_ok=True)
     filename = 'acbs-{}'.format(int(time.time()))
     with open(os.path.join(groups, filename), 'wt') as f:
         f.write(checkpoint_text(packages))
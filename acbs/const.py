@@ -19,3 +19,7 @@ DUMP_DIR = '/var/cache/acbs/tarballs/'
 TMP_DIR = '/var/cache/acbs/build/'
 LOG_DIR = '/var/log/acbs/'
 DPKG_DIR = '/var/lib/dpkg/'
+APT_LISTS_DIR = '/var/lib/apt/lists/'
+
+# Maximum number of sources fetched concurrently (download-only mode)
+FETCH_JOBS = 4
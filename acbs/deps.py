@@ -1,5 +1,5 @@
-from collections import OrderedDict, defaultdict, deque
-from typing import List, Dict, Deque
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 
 from acbs.find import find_package
 from acbs.parser import ACBSPackageInfo, check_buildability
@@ -13,21 +13,109 @@ def tarjan_search(packages: 'OrderedDict[str, ACBSPackageInfo]', search_path: st
     The resulting list of ACBSPackageInfo are sorted topologically as a byproduct of the algorithm
     """
     # Initialize state trackers
-    lowlink: Dict[str, int] = defaultdict(lambda: -1)
-    index: Dict[str, int] = defaultdict(lambda: -1)
-    stackstate: Dict[str, bool] = defaultdict(bool)
-    stack: Deque[str] = deque()
+    lowlink: Dict[str, int] = {}
+    index: Dict[str, int] = {}
+    stackstate: Set[str] = set()
+    stack: List[str] = []
     results: List[List[ACBSPackageInfo]] = []
     packages_list: List[str] = [i for i in packages]
     pool.update(packages)
-    for i in packages_list:
-        if index[i] == -1:  # recurse on each package that is not yet visited
+    # packages_list may grow during the search (when package groups are expanded)
+    cursor = 0
+    while cursor < len(packages_list):
+        i = packages_list[cursor]
+        cursor += 1
+        if i not in index:  # search on each package that is not yet visited
             strongly_connected(search_path, packages_list, results, packages,
                                i, lowlink, index, stackstate, stack, stage2)
     return results
 
 
-def prepare_for_reorder(package: ACBSPackageInfo, packages_list: List[str]) -> ACBSPackageInfo:
+def schedule_packages(packages: List[ACBSPackageInfo]) -> List[ACBSPackageInfo]:
+    """This function sorts the topologically ordered packages by their levels.
+    The level of a package is the length of the longest chain of dependencies below it,
+    packages in the same level do not depend on each other.
+    Inside each level, packages heading the longest chain of dependents come first (Hu's algorithm),
+    then the ones with more dependents.
+    Package groups are scheduled as a whole so that their members are built together,
+    unless a member depends on a package which depends on another member.
+    """
+    position = {p.name: n for n, p in enumerate(packages)}
+    deps: Dict[str, List[str]] = {}
+    group_last: Dict[str, str] = {}
+    groups: Dict[str, List[str]] = {}
+    for p in packages:
+        here = position[p.name]
+        # only consider the dependencies scheduled before this package (ignores loops),
+        # installable dependencies in the queue count as well, they need to be rebuilt first
+        deps[p.name] = [d for d in dict.fromkeys(p.deps + p.installables) if position.get(d, here) < here]
+        # packages inside a group must be built in sequence
+        if p.base_slug:
+            if p.base_slug in group_last:
+                deps[p.name].append(group_last[p.base_slug])
+            group_last[p.base_slug] = p.name
+            groups.setdefault(p.base_slug, []).append(p.name)
+    # each package is a scheduling unit of its own, then the groups are merged into single units
+    unit_of = {p.name: p.name for p in packages}
+    graph = sort_units(packages, deps, unit_of)
+    assert graph is not None
+    for members in groups.values():
+        merged = dict(unit_of)
+        merged.update(dict.fromkeys(members, members[0]))
+        merged_graph = sort_units(packages, deps, merged)
+        # merging would create a loop when another package is sandwiched between the members
+        if merged_graph is not None:
+            unit_of, graph = merged, merged_graph
+    order, edges = graph
+    level: Dict[str, int] = {}
+    for u in order:
+        level[u] = 1 + max((level[d] for d in edges[u]), default=0)
+    chain: Dict[str, int] = {}
+    fanin: Dict[str, int] = {}
+    for u in reversed(order):
+        chain.setdefault(u, 1)
+        for d in edges[u]:
+            chain[d] = max(chain.get(d, 1), chain[u] + 1)
+            fanin[d] = fanin.get(d, 0) + 1
+    units: Dict[str, List[ACBSPackageInfo]] = {}
+    for p in packages:
+        units.setdefault(unit_of[p.name], []).append(p)
+    scheduled = sorted(units, key=lambda u: (level[u], -chain[u], -fanin.get(u, 0)))
+    return [p for u in scheduled for p in units[u]]
+
+
+def sort_units(packages: List[ACBSPackageInfo], deps: Dict[str, List[str]],
+               unit_of: Dict[str, str]) -> Optional[Tuple[List[str], Dict[str, List[str]]]]:
+    """This function builds the dependency graph between the scheduling units and sorts it topologically (Kahn's algorithm).
+    Returns None when the units depend on each other in a loop
+    """
+    edges: Dict[str, Dict[str, None]] = {}
+    for p in packages:
+        unit = unit_of[p.name]
+        unit_edges = edges.setdefault(unit, {})
+        for d in deps[p.name]:
+            if unit_of[d] != unit:
+                unit_edges[unit_of[d]] = None
+    pending = {u: len(e) for u, e in edges.items()}
+    dependents: Dict[str, List[str]] = {}
+    for u, e in edges.items():
+        for d in e:
+            dependents.setdefault(d, []).append(u)
+    order = [u for u, n in pending.items() if n == 0]
+    # order grows during the sort
+    cursor = 0
+    while cursor < len(order):
+        for u in dependents.get(order[cursor], []):
+            pending[u] -= 1
+            if pending[u] == 0:
+                order.append(u)
+        cursor += 1
+    if len(order) < len(edges):
+        return None
+    return order, {u: list(e) for u, e in edges.items()}
+
+
+def prepare_for_reorder(package: ACBSPackageInfo, package_names: Set[str]) -> ACBSPackageInfo:
     """This function prepares the package for reordering.
     The idea is to move the installable dependencies which are in the build list to the "uninstallable" list.
     """
@@ -37,25 +125,17 @@ def prepare_for_reorder(package: ACBSPackageInfo, packages_list: List[str]) -> A
         if d == package.name:
             new_installables.append(d)
             continue
-        try:
-            packages_list.index(d)
+        if d in package_names:
             package.deps.append(d)
-        except ValueError:
+        else:
             new_installables.append(d)
     package.installables = new_installables
     return package
 
 
-def strongly_connected(search_path: str, packages_list: List[str], results: list, packages: 'OrderedDict[str, ACBSPackageInfo]', vert: str, lowlink: Dict[str, int], index: Dict[str, int], stackstate: Dict[str, bool], stack: Deque[str], stage2: bool, depth=0):
-    # update depth indices
-    index[vert] = depth
-    lowlink[vert] = depth
-    depth += 1
-    stackstate[vert] = True
-    stack.append(vert)
-
+def search_package(search_path: str, packages_list: List[str], packages: 'OrderedDict[str, ACBSPackageInfo]',
+                   vert: str, stage2: bool, required_by: str) -> ACBSPackageInfo:
     # search package begin
-    print(f'[{len(results) + 1}/{len(pool)}] {vert:30}\r', end='', flush=True)
     current_package = packages.get(vert)
     if current_package is None:
         package = pool.get(vert) or find_package(vert, search_path, stage2)
@@ -76,27 +156,52 @@ def strongly_connected(search_path: str, packages_list: List[str], results: list
     assert current_package is not None
     # first check if this dependency is buildable
     # when `required_by` argument is present, it will raise an exception when the dependency is unbuildable.
-    check_buildability(current_package, stack[-2] if len(stack) > 1 else '<unknown>')
+    check_buildability(current_package, required_by)
     # search package end
-    # Look for adjacent packages (dependencies)
-    for p in current_package.deps:
-        if index[p] == -1:
-            # recurse on unvisited packages
-            strongly_connected(search_path, packages_list, results, packages,
-                               p, lowlink, index, stackstate, stack, depth)
-            lowlink[vert] = min(lowlink[p], lowlink[vert])
-        # adjacent package is in the stack which means it is part of a loop
-        elif stackstate[p] is True:
-            lowlink[vert] = min(lowlink[p], index[vert])
-
-    w = ''
-    result = []
-    # if this is a root vertex
-    if lowlink[vert] == index[vert]:
-        # the current stack contains the vertices that belong to the same loop
-        # if the stack only contains one vertex, then there is no loop there
-        while w != vert:
-            w = stack.pop()
-            result.append(pool[w])
-            stackstate[w] = False
-        results.append(result)
+    return current_package
+
+
+def strongly_connected(search_path: str, packages_list: List[str], results: list, packages: 'OrderedDict[str, ACBSPackageInfo]', root: str, lowlink: Dict[str, int], index: Dict[str, int], stackstate: Set[str], stack: List[str], stage2: bool):
+    # The depth-first search is done using an explicit stack instead of recursion,
+    # each frame holds a vertex and an iterator over its adjacent packages (dependencies)
+    frames: List[Tuple[str, Iterator[str]]] = []
+
+    def visit(vert: str, required_by: str):
+        # update depth indices
+        index[vert] = len(index)
+        lowlink[vert] = index[vert]
+        stackstate.add(vert)
+        stack.append(vert)
+        print(f'[{len(results) + 1}/{len(pool)}] {vert:30}\r', end='', flush=True)
+        current_package = search_package(search_path, packages_list, packages, vert, stage2, required_by)
+        frames.append((vert, iter(current_package.deps)))
+
+    visit(root, '<unknown>')
+    while frames:
+        vert, adjacent = frames[-1]
+        # Look for adjacent packages (dependencies)
+        for p in adjacent:
+            if p not in index:
+                # descend into unvisited packages, continue with the rest of them later
+                visit(p, vert)
+                break
+            # adjacent package is in the stack which means it is part of a loop
+            elif p in stackstate:
+                lowlink[vert] = min(lowlink[vert], index[p])
+        else:
+            # all the dependencies are visited, return to the parent
+            frames.pop()
+            if frames:
+                parent = frames[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[vert])
+            # if this is a root vertex
+            if lowlink[vert] == index[vert]:
+                # the current stack contains the vertices that belong to the same loop
+                # if the stack only contains one vertex, then there is no loop there
+                w = ''
+                result = []
+                while w != vert:
+                    w = stack.pop()
+                    result.append(pool[w])
+                    stackstate.discard(w)
+                results.append(result)
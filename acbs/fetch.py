@@ -2,7 +2,8 @@ import logging
 import os
 import shutil
 import subprocess
-from typing import Callable, Dict, Optional, Tuple, List
+import threading
+from typing import Callable, Dict, Optional, Set, Tuple, List
 
 from acbs.base import ACBSPackageInfo, ACBSSourceInfo
 from acbs.crypto import check_hash_hashlib, hash_url
@@ -13,22 +14,66 @@ fetcher_signature = Callable[[ACBSSourceInfo,
 processor_signature = Callable[[ACBSPackageInfo, int, str], None]
 pair_signature = Tuple[fetcher_signature, processor_signature]
 generate_mode = False
+# per-thread fetcher states, fetches running in the background must not write to the terminal
+fetch_state = threading.local()
+# child processes of the running fetchers, so that they can be stopped when bailing out
+fetch_processes: Set[subprocess.Popen] = set()
+fetch_lock = threading.Lock()
+fetch_cancelled = threading.Event()
 
 
-def fetch_source(info: List[ACBSSourceInfo], source_location: str, package_name: str) -> Optional[ACBSSourceInfo]:
+def fetch_source(info: List[ACBSSourceInfo], source_location: str, package_name: str,
+                 quiet=False) -> Optional[ACBSSourceInfo]:
     logging.info('Fetching required source files...')
-    count = 0
-    for i in info:
-        count += 1
-        logging.info(f'Fetching source ({count}/{len(info)})...')
-        # in generate mode, we need to fetch all the sources
-        if not i.enabled and not generate_mode:
-            logging.info(f'Source {count} skipped.')
-        url_hash = hash_url(i.url)
-        fetch_source_inner(i, source_location, url_hash)
+    fetch_state.quiet = quiet
+    try:
+        count = 0
+        for i in info:
+            count += 1
+            logging.info(f'Fetching source ({count}/{len(info)})...')
+            # in generate mode, we need to fetch all the sources
+            if not i.enabled and not generate_mode:
+                logging.info(f'Source {count} skipped.')
+            url_hash = hash_url(i.url)
+            fetch_source_inner(i, source_location, url_hash)
+    finally:
+        fetch_state.quiet = False
     return None
 
 
+def fetch_call(command: List[str], **kwargs) -> None:
+    """subprocess.check_call() for the fetchers, which silences the command in quiet mode
+    and keeps track of the child process, see cancel_fetches()
+    """
+    if getattr(fetch_state, 'quiet', False):
+        kwargs.update(stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # don't let git ask for credentials on the terminal either
+        kwargs['env'] = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+    with fetch_lock:
+        if fetch_cancelled.is_set():
+            raise RuntimeError('Fetching has been cancelled.')
+        proc = subprocess.Popen(command, **kwargs)
+        fetch_processes.add(proc)
+    try:
+        retcode = proc.wait()
+    finally:
+        with fetch_lock:
+            fetch_processes.discard(proc)
+    if retcode:
+        raise subprocess.CalledProcessError(retcode, command)
+
+
+def cancel_fetches() -> None:
+    """Stop the running fetchers (e.g. the ones in the background) when the build fails,
+    so that they don't outlive acbs and race with the fetchers of the next run.
+    The fetches in progress fail without being retried.
+    """
+    with fetch_lock:
+        fetch_cancelled.set()
+        for proc in fetch_processes:
+            proc.terminate()
+
+
 def fetch_source_inner(info: ACBSSourceInfo, source_location: str, package_name: str) -> Optional[ACBSSourceInfo]:
     type_ = info.type
     retry = 0
@@ -40,6 +85,8 @@ def fetch_source_inner(info: ACBSSourceInfo, source_location: str, package_name:
         try:
             return fetcher[0](info, source_location, package_name)
         except Exception as ex:
+            if fetch_cancelled.is_set():
+                raise RuntimeError('Fetching has been cancelled.') from ex
             logging.exception(ex)
             logging.warning(f'Retrying ({retry}/5)...')
             continue
@@ -76,7 +123,7 @@ def tarball_fetch(info: ACBSSourceInfo, source_location: str, name: str) -> Opti
             # if the download has finished successfully, we don't overwrite the downloaded file
             with open(flag_path, 'wb') as f:
                 f.write(b'')
-            subprocess.check_call(
+            fetch_call(
                 ['wget', '-c', info.url, '-O', full_path])
             info.source_location = full_path
             os.unlink(flag_path)  # delete the flag
@@ -122,10 +169,10 @@ def blob_processor(package: ACBSPackageInfo, index: int, source_name: str) -> No
 def git_fetch(info: ACBSSourceInfo, source_location: str, name: str) -> Optional[ACBSSourceInfo]:
     full_path = os.path.join(source_location, name)
     if not os.path.exists(full_path):
-        subprocess.check_call(['git', 'clone', '--bare', info.url, full_path])
+        fetch_call(['git', 'clone', '--bare', info.url, full_path])
     else:
         logging.info('Updating repository...')
-        subprocess.check_call(
+        fetch_call(
             ['git', 'fetch', 'origin', '+refs/heads/*:refs/heads/*', '--prune'], cwd=full_path)
     info.source_location = full_path
     return info
@@ -177,10 +224,10 @@ def svn_fetch(info: ACBSSourceInfo, source_location: str, name: str) -> Optional
     logging.info(
         f'Checking out subversion repository at r{info.revision}')
     if not os.path.exists(full_path):
-        subprocess.check_call(
+        fetch_call(
             ['svn', 'co', '--force', '-r', info.revision, info.url, full_path])
     else:
-        subprocess.check_call(
+        fetch_call(
             ['svn', 'up', '--force', '-r', info.revision], cwd=full_path)
     info.source_location = full_path
     return info
@@ -199,10 +246,10 @@ def svn_processor(package: ACBSPackageInfo, index: int, source_name: str) -> Non
 def hg_fetch(info: ACBSSourceInfo, source_location: str, name: str) -> Optional[ACBSSourceInfo]:
     full_path = os.path.join(source_location, name)
     if not os.path.exists(full_path):
-        subprocess.check_call(['hg', 'clone', '-U', info.url, full_path])
+        fetch_call(['hg', 'clone', '-U', info.url, full_path])
     else:
         logging.info('Updating repository...')
-        subprocess.check_call(['hg', 'pull'], cwd=full_path)
+        fetch_call(['hg', 'pull'], cwd=full_path)
     info.source_location = full_path
     return info
 
@@ -240,10 +287,10 @@ def dummy_processor(package: ACBSPackageInfo, index: int, source_name: str) -> N
 def bzr_fetch(info: ACBSSourceInfo, source_location: str, name: str) -> Optional[ACBSSourceInfo]:
     full_path = os.path.join(source_location, name)
     if not os.path.exists(full_path):
-        subprocess.check_call(['bzr', 'branch', '--no-tree', info.url, full_path])
+        fetch_call(['bzr', 'branch', '--no-tree', info.url, full_path])
     else:
         logging.info('Updating repository...')
-        subprocess.check_call(['bzr', 'pull'], cwd=full_path)
+        fetch_call(['bzr', 'pull'], cwd=full_path)
     info.source_location = full_path
     return info
 
@@ -267,10 +314,10 @@ def bzr_processor(package: ACBSPackageInfo, index: int, source_name: str) -> Non
 def fossil_fetch(info: ACBSSourceInfo, source_location: str, name: str) -> Optional[ACBSSourceInfo]:
     full_path = os.path.join(source_location, name + '.fossil')
     if not os.path.exists(full_path):
-        subprocess.check_call(['fossil', 'clone', info.url, full_path])
+        fetch_call(['fossil', 'clone', info.url, full_path])
     else:
         logging.info('Updating repository...')
-        subprocess.check_call(['fossil', 'pull', '-R', full_path])
+        fetch_call(['fossil', 'pull', '-R', full_path])
     info.source_location = full_path
     return info
 
@@ -128,24 +128,25 @@ def expand_package_group(package: ACBSPackageInfo, search_path: str, stage2: boo
     group_root = os.path.join(search_path, package.base_slug)
     original_base = package.base_slug
     actionables: List[ACBSPackageInfo] = []
-    for entry in os.scandir(group_root):
-        if not entry.is_dir():
-            continue
-        name = entry.name
-        splitted = name.split('-', 1)
-        if len(splitted) != 2:
-            raise ValueError(
-                'Malformed sub-package name: {name}'.format(name=entry.name))
-        try:
-            sequence = int(splitted[0])
-            package = parse_package(entry.path, stage2)
-            if package:
-                package.base_slug = original_base
-                package.group_seq = sequence
-                actionables.append(package)
-        except ValueError as ex:
-            raise ValueError(
-                'Malformed sub-package name: {name}'.format(name=entry.name)) from ex
+    with os.scandir(group_root) as it:
+        for entry in it:
+            if not entry.is_dir():
+                continue
+            name = entry.name
+            splitted = name.split('-', 1)
+            if len(splitted) != 2:
+                raise ValueError(
+                    'Malformed sub-package name: {name}'.format(name=entry.name))
+            try:
+                sequence = int(splitted[0])
+                package = parse_package(entry.path, stage2)
+                if package:
+                    package.base_slug = original_base
+                    package.group_seq = sequence
+                    actionables.append(package)
+            except ValueError as ex:
+                raise ValueError(
+                    'Malformed sub-package name: {name}'.format(name=entry.name)) from ex
     # because the directory order is arbitrary, we need to sort them
     actionables = sorted(actionables, key=lambda a: a.group_seq)
     # pre-assign build location for sub-packages
@@ -1,11 +1,13 @@
+import atexit
 import logging
 import logging.handlers
 import os
+import queue
 import sys
 import time
 import traceback
-from pathlib import Path
-from typing import List, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import List, Optional, Tuple
 
 import acbs.fetch
 import acbs.parser
@@ -14,17 +16,21 @@ from acbs import __version__
 from acbs.ab3cfg import is_in_stage2
 from acbs.base import ACBSPackageInfo
 from acbs.checkpoint import ACBSShrinkWrap, do_shrink_wrap, checkpoint_to_group
-from acbs.const import CONF_DIR, DUMP_DIR, LOG_DIR, TMP_DIR, AUTOBUILD_CONF_DIR
-from acbs.deps import tarjan_search, prepare_for_reorder
+from acbs.const import CONF_DIR, DUMP_DIR, LOG_DIR, TMP_DIR, AUTOBUILD_CONF_DIR, FETCH_JOBS
+from acbs.deps import tarjan_search, prepare_for_reorder, schedule_packages
 from acbs.fetch import fetch_source, process_source
 from acbs.find import check_package_groups, find_package
 from acbs.parser import get_deps_graph, get_tree_by_name, arch, check_buildability
-from acbs.pm import install_from_repo
+from acbs.pm import install_from_repo, load_caches
 from acbs.utils import (ACBSLogFormatter, full_line_banner, guess_subdir,
-                        has_stamp, invoke_autobuild, make_build_dir,
+                        has_stamp, make_stamp, share_sources, group_by_sources,
+                        invoke_autobuild, make_build_dir,
                         print_build_timings, print_package_names, write_checksums,
                         generate_checksums, is_spec_legacy, check_artifact)
 
+# name prefix of the threads fetching sources in the background
+FETCH_THREAD_NAME = 'acbs-fetch'
+
 
 class BuildCore(object):
 
@@ -46,6 +52,9 @@ class BuildCore(object):
         self.tmp_dir = TMP_DIR
         self.log_dir = LOG_DIR
         self.stage2 = is_in_stage2()
+        # environment variables inherited by all the builds
+        self.build_env = os.environ.copy()
+        self.log_listener: Optional[logging.handlers.QueueListener] = None
         if args.acbs_tree:
             self.tree = args.acbs_tree[0]
         self.init()
@@ -61,18 +70,18 @@ class BuildCore(object):
         try:
             for directory in [self.dump_dir, self.tmp_dir, self.conf_dir,
                               self.log_dir]:
-                if not os.path.isdir(directory):
-                    os.makedirs(directory)
+                os.makedirs(directory, exist_ok=True)
         except Exception:
             raise IOError('\033[93mFailed to create work directories\033[0m!')
         self.__install_logger(log_verbosity)
+        load_caches(self.dump_dir)
         forest_file = os.path.join(self.conf_dir, 'forest.conf')
-        if os.path.exists(forest_file):
+        try:
             self.tree_dir = get_tree_by_name(forest_file, self.tree)
-            if not self.tree_dir:
-                raise ValueError('Tree not found!')
-        else:
-            raise Exception('forest.conf not found')
+        except FileNotFoundError as ex:
+            raise Exception('forest.conf not found') from ex
+        if not self.tree_dir:
+            raise ValueError('Tree not found!')
 
     def __install_logger(self, str_verbosity=logging.INFO,
                          file_verbosity=logging.DEBUG):
@@ -81,13 +90,30 @@ class BuildCore(object):
         str_handler = logging.StreamHandler()
         str_handler.setLevel(str_verbosity)
         str_handler.setFormatter(ACBSLogFormatter())
+        # logs from the background fetcher would be mixed into the build output, keep them in the log file only
+        str_handler.addFilter(lambda record: not record.threadName.startswith(FETCH_THREAD_NAME))
         logger.addHandler(str_handler)
         log_file_handler = logging.handlers.RotatingFileHandler(
             os.path.join(self.log_dir, 'acbs-build.log'), mode='a', maxBytes=2e5, backupCount=3)
         log_file_handler.setLevel(file_verbosity)
         log_file_handler.setFormatter(logging.Formatter(
             '%(asctime)s:%(levelname)s:%(message)s'))
-        logger.addHandler(log_file_handler)
+        # log file writes are handed over to a background thread,
+        # while the console output stays synchronous to keep it in order with the other outputs
+        log_queue: queue.Queue = queue.Queue(-1)
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        queue_handler.setLevel(file_verbosity)
+        logger.addHandler(queue_handler)
+        self.log_listener = logging.handlers.QueueListener(
+            log_queue, log_file_handler, respect_handler_level=True)
+        self.log_listener.start()
+        atexit.register(self.shutdown)
+
+    def shutdown(self) -> None:
+        # flush the pending log records
+        if self.log_listener:
+            self.log_listener.stop()
+            self.log_listener = None
 
     def build(self) -> None:
         packages = []
@@ -110,7 +136,7 @@ class BuildCore(object):
             return
         logging.info(
             f'Dependencies resolved, {len(packages)} packages in the queue')
-        logging.debug(f'Queue: {packages}')
+        logging.debug('Queue: %s', print_package_names(packages))
         logging.info(
             f'Packages to be built: {print_package_names(packages, 5)}')
         if self.save_list:
@@ -137,7 +163,7 @@ class BuildCore(object):
     def reorder_deps(self, packages, stage2: bool):
         logging.info('Re-ordering packages...')
         new_packages = []
-        package_names = [p.name for p in packages]
+        package_names = {p.name for p in packages}
         for pkg in packages:
             # prepare for re-order if necessary
             logging.debug(f'Prepare for re-ordering: {pkg.name}')
@@ -199,65 +225,122 @@ class BuildCore(object):
         if error:
             raise RuntimeError(
                 'Dependencies NOT resolved. Couldn\'t continue!')
+        if not self.no_deps:
+            packages[:] = schedule_packages(packages)
         if not self.reorder:
             # TODO: correctly hoist the packages inside the groups
             check_package_groups(packages)
         return resolved
 
+    def fetch_parallel(self, build_timings, packages):
+        # without building, the sources of different packages are independent from each other,
+        # so they can be fetched concurrently. Packages (transitively) sharing any source
+        # (e.g. sub-packages in a group) are fetched sequentially in the same job to avoid racing on the same destination.
+        jobs = group_by_sources(packages)
+
+        def fetch_job(job: List[ACBSPackageInfo]):
+            for task in job:
+                self.fetch_task(task, quiet=True)
+
+        logging.info(f'Fetching sources for {len(packages)} packages...')
+        with ThreadPoolExecutor(max_workers=FETCH_JOBS, thread_name_prefix=FETCH_THREAD_NAME) as executor:
+            futures = {executor.submit(fetch_job, job): job for job in jobs}
+            try:
+                for future in as_completed(futures):
+                    future.result()
+                    for task in futures[future]:
+                        self.package_cursor += 1
+                        logging.info(f'Fetched {task.name} ({self.package_cursor}/{len(packages)})')
+                        if self.generate:
+                            spec_location = os.path.join(
+                                task.script_location, '..', 'spec')
+                            is_legacy = is_spec_legacy(spec_location)
+                            checksum = generate_checksums(task.source_uri, is_legacy)
+                            write_checksums(spec_location, checksum)
+                            logging.info(f'Updated checksum for {task.name}')
+                        build_timings.append((task.name, -1))
+            except BaseException:
+                # don't wait for the rest of the jobs, so that the checkpoint is saved right away
+                for future in futures:
+                    future.cancel()
+                acbs.fetch.cancel_fetches()
+                raise
+
     def build_sequential(self, build_timings, packages):
-        # build process
-        for task in packages:
-            self.package_cursor += 1
-            logging.info(
-                f'Building {task.name} ({self.package_cursor}/{len(packages)})...')
-            source_name = task.name
-            if task.base_slug:
-                source_name = os.path.basename(task.base_slug)
-            if not has_stamp(task.build_location):
-                fetch_source(task.source_uri, self.dump_dir, source_name)
-            if self.dl_only:
-                if self.generate:
-                    spec_location = os.path.join(
-                        task.script_location, '..', 'spec')
-                    is_legacy = is_spec_legacy(spec_location)
-                    checksum = generate_checksums(task.source_uri, is_legacy)
-                    write_checksums(spec_location, checksum)
-                    logging.info(f'Updated checksum for {task.name}')
-                build_timings.append((task.name, -1))
-                continue
-            if not task.build_location:
-                build_dir = make_build_dir(self.tmp_dir)
-                task.build_location = build_dir
-                process_source(task, source_name)
-            else:
-                # First sub-package in a meta-package
-                if not has_stamp(task.build_location):
+        if self.dl_only:
+            self.fetch_parallel(build_timings, packages)
+            return
+        prefetched: Optional[Future] = None
+        fetcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix=FETCH_THREAD_NAME)
+        try:
+            # build process
+            for n, task in enumerate(packages):
+                self.package_cursor += 1
+                logging.info(
+                    f'Building {task.name} ({self.package_cursor}/{len(packages)})...')
+                source_name = task.name
+                if task.base_slug:
+                    source_name = os.path.basename(task.base_slug)
+                stamped = has_stamp(task.build_location)
+                if prefetched:
+                    try:
+                        prefetched.result()
+                    except Exception as ex:
+                        logging.warning(f'Background fetch failed, retrying: {ex}')
+                        fetch_source(task.source_uri, self.dump_dir, source_name)
+                elif not stamped:
+                    fetch_source(task.source_uri, self.dump_dir, source_name)
+                prefetched = None
+                # fetch the sources of the next package in the background while this one is being built,
+                # unless they share any source (e.g. sub-packages in a group) which is still being used here
+                if n + 1 < len(packages) and not share_sources(task, packages[n + 1]):
+                    prefetched = fetcher.submit(self.fetch_task, packages[n + 1], True)
+                if not task.build_location:
+                    build_dir = make_build_dir(self.tmp_dir)
+                    task.build_location = build_dir
                     process_source(task, source_name)
-                    Path(os.path.join(task.build_location, '.acbs-stamp')).touch()
-                build_dir = task.build_location
-            if task.subdir:
-                build_dir = os.path.join(build_dir, task.subdir)
-            else:
-                subdir = guess_subdir(build_dir)
-                if not subdir:
+                else:
+                    # First sub-package in a meta-package
+                    if not stamped:
+                        process_source(task, source_name)
+                        make_stamp(task.build_location)
+                    build_dir = task.build_location
+                if task.subdir:
+                    build_dir = os.path.join(build_dir, task.subdir)
+                else:
+                    subdir = guess_subdir(build_dir)
+                    if not subdir:
+                        raise RuntimeError(
+                            'Could not determine sub-directory, please specify manually.')
+                    build_dir = os.path.join(build_dir, subdir)
+                if task.installables:
+                    logging.info('Installing dependencies from repository...')
+                    install_from_repo(task.installables)
+                start = time.monotonic()
+                try:
+                    invoke_autobuild(task, build_dir, self.build_env)
+                    check_artifact(task.name, build_dir)
+                except Exception:
+                    # early printing of build summary before exploding
+                    if build_timings:
+                        print_build_timings(build_timings)
                     raise RuntimeError(
-                        'Could not determine sub-directory, please specify manually.')
-                build_dir = os.path.join(build_dir, subdir)
-            if task.installables:
-                logging.info('Installing dependencies from repository...')
-                install_from_repo(task.installables)
-            start = time.monotonic()
-            try:
-                invoke_autobuild(task, build_dir)
-                check_artifact(task.name, build_dir)
-            except Exception:
-                # early printing of build summary before exploding
-                if build_timings:
-                    print_build_timings(build_timings)
-                raise RuntimeError(
-                    f'Error when building {task.name}.\nBuild folder: {build_dir}')
-            task_name = f'{task.name} ({task.bin_arch} @ {task.epoch + ":" if task.epoch else ""}{task.version}-{task.rel})'
-            build_timings.append((task_name, time.monotonic() - start))
+                        f'Error when building {task.name}.\nBuild folder: {build_dir}')
+                task_name = f'{task.name} ({task.bin_arch} @ {task.epoch + ":" if task.epoch else ""}{task.version}-{task.rel})'
+                build_timings.append((task_name, time.monotonic() - start))
+        except BaseException:
+            # stop the background fetch instead of waiting for it, so that the checkpoint is saved right away
+            acbs.fetch.cancel_fetches()
+            fetcher.shutdown(wait=False)
+            raise
+        fetcher.shutdown()
+
+    def fetch_task(self, task: ACBSPackageInfo, quiet=False):
+        source_name = task.name
+        if task.base_slug:
+            source_name = os.path.basename(task.base_slug)
+        if not has_stamp(task.build_location):
+            fetch_source(task.source_uri, self.dump_dir, source_name, quiet)
 
     def acbs_except_hdr(self, type_, value, tb):
         logging.debug('Traceback:\n' + ''.join(traceback.format_tb(tb)))
@@ -136,7 +136,7 @@ def parse_package_url_legacy(var: Dict[str, str]) -> ACBSSourceInfo:
 
 
 def parse_package(location: str, stage2: bool) -> ACBSPackageInfo:
-    logging.debug('Parsing {}...'.format(location))
+    logging.debug('Parsing %s...', location)
     # Call a helper function to check if there's a stage2 defines automatically
     defines_location = get_defines_file_path(location, stage2)
     spec_location = os.path.join(location, '..', 'spec')
@@ -159,8 +159,9 @@ def parse_package(location: str, stage2: bool) -> ACBSPackageInfo:
         result = ACBSPackageInfo(
             name=var['PKGNAME'], deps=[], location=location, source_uri=acbs_source_info)
     else:
+        # the same package may appear in both PKGDEP and BUILDDEP, keep the first occurrence only
         result = ACBSPackageInfo(
-            name=var['PKGNAME'], deps=deps.split(), location=location, source_uri=acbs_source_info)
+            name=var['PKGNAME'], deps=list(dict.fromkeys(deps.split())), location=location, source_uri=acbs_source_info)
     result.bin_arch = var.get('ABHOST') or arch
     fail_arch = var.get('FAIL_ARCH')
     release = spec_var.get('REL') or '0'
@@ -1,14 +1,21 @@
 import logging
+import os
+import pickle
 import re
 import subprocess
-from typing import List, Dict
+from typing import List, Dict, FrozenSet, Optional
 
 from acbs.base import ACBSPackageInfo
+from acbs.const import APT_LISTS_DIR, DPKG_DIR
 
 installed_cache: Dict[str, bool] = {}
+installed_cache_primed: bool = False
 available_cache: Dict[str, bool] = {}
+# names of all the packages known to APT, including virtual packages (`apt-cache pkgnames`)
+known_packages: Optional[FrozenSet[str]] = None
 use_native_bindings: bool = True
 reorder_mode: bool = False
+escape_pattern = re.compile(r'([+*?])')
 
 try:
     from acbs.miniapt_query import apt_init_system, check_if_available as apt_check_if_available
@@ -22,12 +29,19 @@ def filter_dependencies(package: ACBSPackageInfo) -> ACBSPackageInfo:
     installables = []
     deps = []
     for dep in package.deps:
-        if check_if_installed(dep):
+        # look up the caches first to skip the checks for the known packages
+        installed = installed_cache.get(dep)
+        if installed is None:
+            installed = check_if_installed(dep)
+        if installed:
             if reorder_mode:
                 # HACK: when reordering dependencies, we need to pretend that they needs to be installed
                 installables.append(dep)
             continue
-        if check_if_available(dep):
+        available = available_cache.get(dep)
+        if available is None:
+            available = check_if_available(dep)
+        if available:
             installables.append(dep)
             continue
         deps.append(dep)
@@ -37,7 +51,7 @@ def filter_dependencies(package: ACBSPackageInfo) -> ACBSPackageInfo:
 
 
 def escape_package_name(name: str) -> str:
-    return re.sub(r'([+*?])', '\\\\\\1', name)
+    return escape_pattern.sub('\\\\\\1', name)
 
 
 def escape_package_name_install(name: str) -> str:
@@ -52,7 +66,9 @@ def fix_pm_states(escaped: List[str]):
     while count < 3:
         try:
             subprocess.call(['dpkg', '--configure', '-a'])
-            subprocess.check_call(['apt-get', 'install', '-yf'])
+            # only try to fix broken dependencies when `apt-get check` (read-only) finds any
+            if subprocess.call(['apt-get', 'check']) != 0:
+                subprocess.check_call(['apt-get', 'install', '-yf'])
             if escaped:
                 command = ['apt-get', 'install', '-y']
                 command.extend(escaped)
@@ -64,14 +80,100 @@ def fix_pm_states(escaped: List[str]):
     raise RuntimeError('Unable to correct package manager states...')
 
 
+def invalidate_caches() -> None:
+    """Drop the package manager caches after the system state has been changed"""
+    global installed_cache_primed, known_packages
+    installed_cache.clear()
+    available_cache.clear()
+    installed_cache_primed = False
+    known_packages = None
+
+
+def prime_installed_cache() -> None:
+    """Populate the installed package cache using a single dpkg-query invocation"""
+    global installed_cache_primed
+    logging.debug('Querying installed packages...')
+    output = subprocess.check_output(
+        ['dpkg-query', '-W', '-f=${Package}\t${Status}\n'], stderr=subprocess.DEVNULL)
+    for line in output.decode('utf-8').splitlines():
+        name, _, status = line.partition('\t')
+        # status is in the form of `<want> <error> <state>`, e.g. `install ok installed`
+        if status.endswith(' installed'):
+            installed_cache[name] = True
+    installed_cache_primed = True
+
+
+def prime_available_cache() -> FrozenSet[str]:
+    """Collect the names of all the packages known to APT using a single apt-cache invocation"""
+    global known_packages
+    logging.debug('Querying available packages...')
+    output = subprocess.check_output(
+        ['apt-cache', 'pkgnames', '-o', 'APT::Cache::AllNames=true'], stderr=subprocess.DEVNULL)
+    known_packages = frozenset(output.decode('utf-8').split())
+    return known_packages
+
+
+def load_caches(dump_dir: str) -> None:
+    """Load the package manager caches saved by a previous run.
+    The saved caches are only used when neither dpkg nor APT states have changed since then,
+    otherwise the caches are re-primed and saved again.
+    Failures are not fatal here, the caches will be primed on demand instead.
+    """
+    global installed_cache_primed, known_packages
+    if use_native_bindings:
+        return
+    cache_file = os.path.join(dump_dir, '.pm-cache.pkl')
+    try:
+        stamps = (os.stat(os.path.join(DPKG_DIR, 'status')).st_mtime_ns,
+                  os.stat(APT_LISTS_DIR).st_mtime_ns)
+    except OSError:
+        return
+    try:
+        with open(cache_file, 'rb') as f:
+            saved = pickle.load(f)
+        if saved[:2] == stamps:
+            logging.debug('Using saved package manager caches')
+            installed_cache.update(dict.fromkeys(saved[2], True))
+            installed_cache_primed = True
+            known_packages = saved[3]
+            return
+    except Exception:
+        pass
+    logging.debug('Package manager states changed, re-priming caches...')
+    try:
+        prime_installed_cache()
+        available = prime_available_cache()
+    except (OSError, subprocess.CalledProcessError) as ex:
+        # leave the caches to be primed lazily by the checks
+        logging.warning(f'Unable to prime package manager caches: {ex}')
+        invalidate_caches()
+        return
+    installed = frozenset(k for k, v in installed_cache.items() if v)
+    try:
+        with open(cache_file, 'wb') as f:
+            pickle.dump((*stamps, installed, available), f)
+    except OSError as ex:
+        logging.warning(f'Unable to save package manager caches: {ex}')
+
+
 def check_if_installed(name: str) -> bool:
-    logging.debug('Checking if %s is installed' % name)
+    global installed_cache_primed
+    logging.debug('Checking if %s is installed', name)
     cached = installed_cache.get(name)
     if cached is not None:
         return cached
     if use_native_bindings:
         logging.debug('... using libapt-pkg')
+        retry = 0
         result = apt_check_if_available(name)
+        # -4: the package manager is in a broken state
+        while result == -4:
+            if retry >= 3:
+                raise RuntimeError('Unable to correct package manager states...')
+            retry += 1
+            fix_pm_states([])
+            invalidate_caches()
+            result = apt_check_if_available(name)
         if result == 0:
             installed_cache[name] = True
             return True
@@ -83,22 +185,21 @@ def check_if_installed(name: str) -> bool:
             installed_cache[name] = False
             available_cache[name] = False
             return False
-        elif result == -4:
-            fix_pm_states([])
-            return check_if_installed(name)
         else:
             raise RuntimeError(f'libapt-pkg binding returned error: {result}')
-    try:
-        subprocess.check_output(['dpkg', '-s', name], stderr=subprocess.STDOUT)
-        installed_cache[name] = True
-        return True
-    except subprocess.CalledProcessError:
-        installed_cache[name] = False
-        return False
+    if not installed_cache_primed:
+        try:
+            prime_installed_cache()
+        except (OSError, subprocess.CalledProcessError) as ex:
+            # consider nothing as installed, just like when `dpkg -s` fails
+            logging.warning(f'Unable to query installed packages: {ex}')
+            installed_cache_primed = True
+    return installed_cache.setdefault(name, False)
 
 
 def check_if_available(name: str) -> bool:
-    logging.debug('Checking if %s is available' % name)
+    global known_packages
+    logging.debug('Checking if %s is available', name)
     cached = available_cache.get(name)
     if cached is not None:
         return cached
@@ -106,12 +207,21 @@ def check_if_available(name: str) -> bool:
         logging.debug('... using libapt-pkg')
         if apt_check_if_available(name) != 1:
             return False
+    if known_packages is None:
+        try:
+            prime_available_cache()
+        except (OSError, subprocess.CalledProcessError) as ex:
+            # consider nothing as available, just like when `apt-cache show` fails
+            logging.warning(f'Unable to query available packages: {ex}')
+            known_packages = frozenset()
+    packages = known_packages or frozenset()
+    if name not in packages:
+        available_cache[name] = False
+        return False
     try:
-        subprocess.check_output(
-            ['apt-cache', 'show', escape_package_name(name)], stderr=subprocess.STDOUT)
-        logging.debug('Checking if %s can be installed' % name)
-        subprocess.check_output(
-            ['apt-get', 'install', '-s', name], stderr=subprocess.STDOUT)
+        logging.debug('Checking if %s can be installed', name)
+        subprocess.check_call(
+            ['apt-get', 'install', '-s', name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         available_cache[name] = True
         return True
     except subprocess.CalledProcessError:
@@ -120,10 +230,8 @@ def check_if_available(name: str) -> bool:
 
 
 def install_from_repo(packages: List[str]):
-    logging.debug('Installing %s' % packages)
-    escaped = []
-    for package in packages:
-        escaped.append(escape_package_name_install(package))
+    logging.debug('Installing %s', packages)
+    escaped = [escape_package_name_install(package) for package in packages]
     command = ['apt-get', 'install', '-y', '-o', 'Dpkg::Options::=--force-confnew']
     command.extend(escaped)
     try:
@@ -132,4 +240,6 @@ def install_from_repo(packages: List[str]):
         logging.warning(
             'Failed to install dependencies, attempting to correct issues...')
         fix_pm_states(escaped)
+    finally:
+        invalidate_caches()
     return
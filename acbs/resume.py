@@ -43,7 +43,7 @@ def do_load_checkpoint(name: str) -> ACBSShrinkWrap:
 
 def do_resume_checkpoint(filename: str, args):
     def resume_build():
-        logging.debug('Queue: {}'.format(resumed_packages))
+        logging.debug('Queue: %s', print_package_names(resumed_packages))
         logging.info('Packages to be resumed: {}'.format(
             print_package_names(resumed_packages, 5)))
         build_timings = state.timings.copy()
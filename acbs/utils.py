@@ -94,13 +94,10 @@ def print_package_names(packages: List[ACBSPackageInfo], limit: Optional[int] =
     :param limit: maximum number of packages to print
     :return: a string containing the names of the packages
     """
-    pkgs = packages
-    if limit is not None and len(packages) > limit:
-        pkgs = packages[:limit]
-    printable_packages = [pkg.name for pkg in pkgs]
+    pkgs = packages if limit is None else packages[:limit]
     more_messages = ' ... and {} more'.format(
-        len(packages) - limit) if limit and limit < len(packages) else ''
-    return ', '.join(printable_packages) + more_messages
+        len(packages) - len(pkgs)) if len(pkgs) < len(packages) else ''
+    return ', '.join(pkg.name for pkg in pkgs) + more_messages
 
 
 def make_build_dir(path: str) -> str:
@@ -110,19 +107,74 @@ def make_build_dir(path: str) -> str:
 def guess_subdir(path: str) -> Optional[str]:
     name = None
     count = 0
-    for subdir in os.scandir(path):
-        if subdir.is_dir():
-            name = subdir.name
-            count += 1
-        if count > 1:
-            return None
+    with os.scandir(path) as it:
+        for subdir in it:
+            if subdir.is_dir():
+                name = subdir.name
+                count += 1
+            if count > 1:
+                return None
     if count < 1:  # probably dummysrc
         name = '.'
     return name
 
 
 def has_stamp(path: str) -> bool:
-    return os.path.exists(os.path.join(path, '.acbs-stamp'))
+    # packages without a pre-assigned build directory are never stamped
+    if not path:
+        return False
+    try:
+        os.stat(os.path.join(path, '.acbs-stamp'))
+        return True
+    except OSError:
+        return False
+
+
+def make_stamp(path: str):
+    os.close(os.open(os.path.join(path, '.acbs-stamp'), os.O_WRONLY | os.O_CREAT, 0o644))
+
+
+def share_sources(a: ACBSPackageInfo, b: ACBSPackageInfo) -> bool:
+    """
+    Check if two packages are using any of the same sources
+
+    :param a: the first package
+    :param b: the second package
+    :returns: whether any source URL is used by both packages
+    """
+    urls = {s.url for s in a.source_uri if s.url}
+    return any(s.url in urls for s in b.source_uri)
+
+
+def group_by_sources(packages: List[ACBSPackageInfo]) -> List[List[ACBSPackageInfo]]:
+    """
+    Group the packages that are (transitively) sharing any source
+
+    :param packages: list of ACBSPackageInfo objects
+    :returns: list of groups, each keeps the order of the packages
+    """
+    # union-find over the package indices
+    parent = list(range(len(packages)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    owner: Dict[str, int] = {}
+    for n, package in enumerate(packages):
+        for source in package.source_uri:
+            if not source.url:
+                continue
+            if source.url in owner:
+                parent[find(n)] = find(owner[source.url])
+            else:
+                owner[source.url] = n
+    groups: Dict[int, List[ACBSPackageInfo]] = {}
+    for n, package in enumerate(packages):
+        groups.setdefault(find(n), []).append(package)
+    return list(groups.values())
 
 
 def start_build_capture(env: Dict[str, str], build_dir: str):
@@ -176,14 +228,14 @@ def check_artifact(name: str, build_dir: str):
         'STOP! Autobuild3 malfunction detected! Returned zero status with no artifact.')
 
 
-def invoke_autobuild(task: ACBSPackageInfo, build_dir: str):
+def invoke_autobuild(task: ACBSPackageInfo, build_dir: str, base_env: Optional[Dict[str, str]] = None):
     dst_dir = os.path.join(build_dir, 'autobuild')
     if os.path.exists(dst_dir) and task.group_seq > 1:
         shutil.rmtree(dst_dir)
     shutil.copytree(task.script_location, dst_dir, symlinks=True)
     # Inject variables to defines
     acbs_helper = os.path.join(task.build_location, '.acbs-script')
-    env_dict = os.environ.copy()
+    env_dict = dict(base_env) if base_env is not None else os.environ.copy()
     env_dict.update({'PKGREL': task.rel, 'PKGVER': task.version,
                      'PKGEPOCH': task.epoch or '0'})
     env_dict.update(task.exported)
@@ -1,13 +1,19 @@
+import contextlib
+import io
 import unittest
 import unittest.mock
 
 import acbs.parser
+import acbs.deps
+import acbs.fetch
 import acbs.find
 import acbs.pm
 
-from acbs.utils import make_build_dir, guess_extension_name, fail_arch_regex
+from acbs.base import ACBSPackageInfo, ACBSSourceInfo
+from acbs.utils import (make_build_dir, guess_extension_name, fail_arch_regex, has_stamp, make_stamp,
+                        print_package_names, group_by_sources)
 from acbs.const import TMP_DIR
-from acbs.deps import tarjan_search
+from acbs.deps import tarjan_search, schedule_packages
 from acbs.parser import get_deps_graph, parse_url_schema
 
 
@@ -26,6 +32,10 @@ def check_scc(resolved):
     return error
 
 
+def make_packages(deps):
+    return [ACBSPackageInfo(name, list(d), '', [ACBSSourceInfo('none', '', '')]) for name, d in deps]
+
+
 def find_package_generic(name: str):
     acbs.parser.arch = 'none'
     acbs.parser.filter_dependencies = fake_pm
@@ -63,6 +73,47 @@ class TestParser(unittest.TestCase):
         error = check_scc(packages)
         self.assertEqual(error, True)
 
+    def test_deps_indirect_loop(self):
+        acbs.parser.arch = 'none'
+        packages = make_packages([('a', ['b']), ('b', ['c']), ('c', ['a']), ('d', ['a'])])
+        resolved = tarjan_search(get_deps_graph(packages), './tests', stage2=False)
+        self.assertEqual([sorted(p.name for p in scc) for scc in resolved], [['a', 'b', 'c'], ['d']])
+
+    def test_deps_long_chain(self):
+        acbs.parser.arch = 'none'
+        count = 5000  # deeper than the default recursion limit
+        packages = make_packages([(f'p{i}', [f'p{i + 1}'] if i + 1 < count else []) for i in range(count)])
+        # don't leave the packages in the cache for the other tests
+        self.addCleanup(acbs.deps.pool.clear)
+        with contextlib.redirect_stdout(io.StringIO()):
+            resolved = tarjan_search(get_deps_graph(packages), './tests', stage2=False)
+        self.assertEqual(check_scc(resolved), False)
+        self.assertEqual([scc[0].name for scc in resolved], [f'p{i}' for i in reversed(range(count))])
+
+    def test_schedule_packages(self):
+        packages = make_packages([('e', []), ('d', []), ('c', ['d']), ('b', ['c']), ('a', ['b', 'e'])])
+        scheduled = [p.name for p in schedule_packages(packages)]
+        self.assertEqual(scheduled, ['d', 'e', 'c', 'b', 'a'])
+        # packages inside a group are scheduled together in their sequence
+        packages = make_packages([('sub-1', []), ('sub-2', []), ('x', []), ('y', ['x'])])
+        for seq, p in enumerate(packages[:2]):
+            p.base_slug = 'group'
+            p.group_seq = seq + 1
+        scheduled = [p.name for p in schedule_packages(packages)]
+        self.assertEqual(scheduled, ['x', 'sub-1', 'sub-2', 'y'])
+        # ... unless a member depends on another package depending on a member
+        packages = make_packages([('sub-1', []), ('x', ['sub-1']), ('sub-2', ['x']), ('y', [])])
+        for seq, p in enumerate((packages[0], packages[2])):
+            p.base_slug = 'group'
+            p.group_seq = seq + 1
+        scheduled = [p.name for p in schedule_packages(packages)]
+        self.assertEqual(scheduled, ['sub-1', 'y', 'x', 'sub-2'])
+        # queued packages which are also available from the repository stay before their dependents
+        packages = make_packages([('libfoo', []), ('app', []), ('app-plugin', ['app'])])
+        packages[1].installables = ['libfoo']
+        scheduled = [p.name for p in schedule_packages(packages)]
+        self.assertEqual(scheduled, ['libfoo', 'app', 'app-plugin'])
+
     def test_fail_arch(self):
         import re
         self.assertEqual(re.compile("^(?!amd64)"), fail_arch_regex("!amd64"))
@@ -139,11 +190,152 @@ class TestMisc(unittest.TestCase):
         self.assertEqual(acbs.pm.escape_package_name_install('test++'), 'test\\+\\++')
         self.assertEqual(acbs.pm.escape_package_name_install('test+-'), 'test\\+-+')
 
+    def test_installed_status(self):
+        acbs.pm.invalidate_caches()
+        output = (b'bash\tinstall ok installed\n'
+                  b'vim\thold ok installed\n'
+                  b'gcc\tinstall reinstreq half-installed\n'
+                  b'nano\tdeinstall ok config-files\n'
+                  b'emacs\tunknown ok not-installed\n')
+        with unittest.mock.patch.object(acbs.pm, 'use_native_bindings', False), \
+                unittest.mock.patch('subprocess.check_output', return_value=output) as check_output:
+            self.assertEqual(acbs.pm.check_if_installed('bash'), True)
+            self.assertEqual(acbs.pm.check_if_installed('vim'), True)
+            self.assertEqual(acbs.pm.check_if_installed('gcc'), False)
+            self.assertEqual(acbs.pm.check_if_installed('nano'), False)
+            self.assertEqual(acbs.pm.check_if_installed('emacs'), False)
+            self.assertEqual(acbs.pm.check_if_installed('nonexistent'), False)
+            # all the checks are answered by a single query
+            check_output.assert_called_once()
+        acbs.pm.invalidate_caches()
+
+    def test_available_provided_name(self):
+        acbs.pm.invalidate_caches()
+        with unittest.mock.patch.object(acbs.pm, 'use_native_bindings', False), \
+                unittest.mock.patch('subprocess.check_output', return_value=b'bash\nawk\nmawk\n') as check_output, \
+                unittest.mock.patch('subprocess.check_call', return_value=0) as check_call:
+            # `awk` is only provided by other packages
+            self.assertEqual(acbs.pm.check_if_available('awk'), True)
+            self.assertEqual(acbs.pm.check_if_available('nonexistent'), False)
+            check_output.assert_called_once_with(
+                ['apt-cache', 'pkgnames', '-o', 'APT::Cache::AllNames=true'], stderr=unittest.mock.ANY)
+            check_call.assert_called_once_with(
+                ['apt-get', 'install', '-s', 'awk'], stdout=unittest.mock.ANY, stderr=unittest.mock.ANY)
+        acbs.pm.invalidate_caches()
+
+    def test_load_caches(self):
+        import os
+        import tempfile
+        acbs.pm.invalidate_caches()
+        outputs = {'dpkg-query': b'bash\tinstall ok installed\n', 'apt-cache': b'bash\nawk\n'}
+
+        def check_output(command, **kwargs):
+            return outputs[command[0]]
+
+        with tempfile.TemporaryDirectory() as d:
+            os.mkdir(os.path.join(d, 'lists'))
+            status = os.path.join(d, 'status')
+            with open(status, 'wb'):
+                pass
+            with unittest.mock.patch.object(acbs.pm, 'use_native_bindings', False), \
+                    unittest.mock.patch.object(acbs.pm, 'DPKG_DIR', d), \
+                    unittest.mock.patch.object(acbs.pm, 'APT_LISTS_DIR', os.path.join(d, 'lists')), \
+                    unittest.mock.patch('subprocess.check_output', side_effect=check_output) as query:
+                # the caches are primed and saved on the first run
+                acbs.pm.load_caches(d)
+                self.assertEqual(query.call_count, 2)
+                self.assertEqual(os.path.exists(os.path.join(d, '.pm-cache.pkl')), True)
+                # ... and reused as long as the package manager states don't change
+                acbs.pm.invalidate_caches()
+                acbs.pm.load_caches(d)
+                self.assertEqual(query.call_count, 2)
+                self.assertEqual(acbs.pm.check_if_installed('bash'), True)
+                self.assertEqual(acbs.pm.known_packages, frozenset(['bash', 'awk']))
+                # the caches are re-primed once the states change
+                acbs.pm.invalidate_caches()
+                outputs['dpkg-query'] += b'awk\tinstall ok installed\n'
+                stamp = os.stat(status).st_mtime_ns + 1000000000
+                os.utime(status, ns=(stamp, stamp))
+                acbs.pm.load_caches(d)
+                self.assertEqual(query.call_count, 4)
+                self.assertEqual(acbs.pm.check_if_installed('awk'), True)
+                # ... and saved again
+                acbs.pm.invalidate_caches()
+                acbs.pm.load_caches(d)
+                self.assertEqual(query.call_count, 4)
+                self.assertEqual(acbs.pm.check_if_installed('awk'), True)
+        acbs.pm.invalidate_caches()
+
+    def test_load_caches_failure(self):
+        import subprocess
+        import tempfile
+        acbs.pm.invalidate_caches()
+        error = subprocess.CalledProcessError(2, 'dpkg-query')
+        with tempfile.TemporaryDirectory() as d, \
+                unittest.mock.patch.object(acbs.pm, 'use_native_bindings', False), \
+                unittest.mock.patch('os.stat'), \
+                unittest.mock.patch('subprocess.check_output', side_effect=error):
+            acbs.pm.load_caches(d)
+        self.assertEqual(acbs.pm.installed_cache_primed, False)
+        self.assertEqual(acbs.pm.known_packages, None)
+        # the checks degrade to negative answers instead of aborting
+        with unittest.mock.patch.object(acbs.pm, 'use_native_bindings', False), \
+                unittest.mock.patch('subprocess.check_output', side_effect=error):
+            self.assertEqual(acbs.pm.check_if_installed('bash'), False)
+            self.assertEqual(acbs.pm.check_if_available('bash'), False)
+        acbs.pm.invalidate_caches()
+
     def test_guess_extension_name(self):
         self.assertEqual(guess_extension_name('test-1.2.3.tar.gz'), '.tar.gz')
         self.assertEqual(guess_extension_name('test-1.2.3.bin'), '.bin')
         self.assertEqual(guess_extension_name('test'), '')
 
+    def test_print_package_names(self):
+        packages = make_packages([(f'p{i}', []) for i in range(7)])
+        self.assertEqual(print_package_names(packages), 'p0, p1, p2, p3, p4, p5, p6')
+        self.assertEqual(print_package_names(packages, 5), 'p0, p1, p2, p3, p4 ... and 2 more')
+        self.assertEqual(print_package_names(packages[:3], 5), 'p0, p1, p2')
+
+    def test_group_by_sources(self):
+        packages = make_packages([('a', []), ('b', []), ('c', []), ('d', []), ('e', [])])
+        for p, urls in zip(packages, [['x'], ['y'], ['x', 'y'], ['z'], ['']]):
+            p.source_uri = [ACBSSourceInfo('tarball', url) for url in urls]
+        groups = [[p.name for p in g] for g in group_by_sources(packages)]
+        self.assertEqual(sorted(groups), [['a', 'b', 'c'], ['d'], ['e']])
+
+    def test_cancel_fetches(self):
+        import subprocess
+        import threading
+        import time
+        errors = []
+
+        def fetch():
+            acbs.fetch.fetch_state.quiet = True
+            try:
+                acbs.fetch.fetch_call(['sleep', '30'])
+            except Exception as ex:
+                errors.append(ex)
+
+        fetcher = threading.Thread(target=fetch)
+        fetcher.start()
+        while not acbs.fetch.fetch_processes:
+            time.sleep(0.01)
+        acbs.fetch.cancel_fetches()
+        fetcher.join(5)
+        self.assertEqual(fetcher.is_alive(), False)
+        self.assertIsInstance(errors[0], subprocess.CalledProcessError)
+        # no more fetchers are started after the cancellation
+        self.assertRaises(RuntimeError, acbs.fetch.fetch_call, ['true'])
+        acbs.fetch.fetch_cancelled.clear()
+
+    def test_stamp(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as d:
+            self.assertEqual(has_stamp(d), False)
+            make_stamp(d)
+            self.assertEqual(has_stamp(d), True)
+        self.assertEqual(has_stamp(''), False)
+
 
 if __name__ == '__main__':
     unittest.main()